@@ -19,23 +19,37 @@ Key features:
 
 Dependencies:
   - gradio
-  - PyPDF2
+  - pypdfium2 (preferred) or PyPDF2
   - google‑genai (>=1.0.0) or google‑generativeai (<1.0.0)
+  - orjson (optional, faster JSON handling)
+  - rank_bm25 (optional, page retrieval for very long documents)
 
 If these packages are missing, the app will not crash but will prompt
 the user accordingly. Install dependencies with pip, for example:
 
 ```
-pip install gradio PyPDF2 google-genai
+pip install gradio pypdfium2 google-genai
 ```
 """
 
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import json
 import logging
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from itertools import repeat
 from pathlib import Path
-from typing import Callable, List, Tuple, Dict, Any
+from typing import AsyncIterator, Callable, Deque, List, Tuple, TypeVar, Dict, Any
 
 try:
     import gradio as gr  # type: ignore
@@ -45,17 +59,36 @@ except ImportError as e:
         "pip install gradio"
     ) from e
 
-# Try to import PyPDF2 for PDF text extraction.
+# Prefer pypdfium2 (native PDFium) for PDF text extraction, falling back to
+# PyPDF2 when it is unavailable.
+try:
+    import pypdfium2 as pdfium  # type: ignore
+except ImportError:
+    pdfium = None  # type: ignore[assignment]
 try:
     from PyPDF2 import PdfReader  # type: ignore
 except ImportError:
     PdfReader = None  # type: ignore[assignment]
 
+# Use orjson for JSON parsing and serialisation when available.
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+# rank_bm25 enables page retrieval for documents too long to send whole.
+try:
+    from rank_bm25 import BM25Okapi  # type: ignore
+except ImportError:
+    BM25Okapi = None  # type: ignore[assignment]
+
 # Attempt to import Gemini API clients. Prefer google-genai if available.
 try:
     from google import genai  # type: ignore
+    from google.genai import errors as genai_errors  # type: ignore
 except ImportError:
     genai = None  # type: ignore[assignment]
+    genai_errors = None  # type: ignore[assignment]
 try:
     import google.generativeai as generativeai  # type: ignore
 except ImportError:
@@ -70,130 +103,714 @@ logger = logging.getLogger(__name__)
 CONTRACT_PATH = Path(__file__).parent / "universal_v4_contract.xml"
 if not CONTRACT_PATH.exists():
     raise FileNotFoundError(f"Prompt contract file not found at {CONTRACT_PATH}")
-with open(CONTRACT_PATH, "r", encoding="utf-8") as fp:
-    PROMPT_CONTRACT: str = fp.read()
+PROMPT_CONTRACT: str = CONTRACT_PATH.read_text(encoding="utf-8")
+# Everything in the prompt that precedes the document text; built once per
+# process rather than re-formatting the contract on every upload.
+CONTEXT_HEADER: str = f"{PROMPT_CONTRACT}\nDocument contents:\n"
+
+GEMINI_MODEL = "gemini-2.5-flash"
+# Lifetime of the Gemini context cache holding the contract and document.
+CONTEXT_CACHE_TTL = "3600s"
+
+# A response wrapped in a Markdown code fence, capturing the fenced body.
+FENCE_RE = re.compile(r"^```(?:json)?\s*\n(.*?)\n?```\s*$", re.DOTALL)
+# The string value of the "answer" key, for reading it from a response that
+# isn't valid JSON.
+ANSWER_RE = re.compile(r'"answer"\s*:\s*"((?:[^"\\]|\\.)*)"')
+# The opening of the "answer" value, and the run of string characters that
+# follows it; together they read the answer while it is still streaming.
+ANSWER_START_RE = re.compile(r'"answer"\s*:\s*"')
+# Escapes are only consumed once complete, so a chunk boundary inside one
+# leaves it for the next read.
+STRING_BODY_RE = re.compile(r'(?:[^"\\]|\\u[0-9a-fA-F]{4}|\\[^u])*')
+
+# The logs keep only the most recent MAX_LOG_ENTRIES entries so a
+# long‑running server doesn't grow without bound.
+MAX_LOG_ENTRIES = 1000
+
+
+def _new_log() -> Deque[Any]:
+    """
+    Return an empty log bounded to MAX_LOG_ENTRIES entries.
+    """
+    return deque(maxlen=MAX_LOG_ENTRIES)
+
+
+@dataclass
+class Session:
+    """
+    State for one user's session: the loaded document, the Gemini client
+    and the logs. Each browser session holds its own instance in a
+    ``gr.State``, so concurrent users never see each other's documents.
+    """
+
+    pdf_text: str = field(default="", repr=False)
+    pdf_pages: List[str] = field(default_factory=list, repr=False)
+    # BM25 index over pdf_pages, built only for documents too long to send
+    # whole.
+    page_index: Any = field(default=None, repr=False)
+    api_key: str = field(default="", repr=False)
+    call: Callable[[str], AsyncIterator[str]] | None = None
+    # Frees server-side resources held for ``call`` (the Gemini context
+    # cache); run when the client is replaced or the session ends.
+    release: Callable[[], None] | None = None
+    conversation_logs: Deque[str] = field(default_factory=_new_log)
+    answer_json_log: Deque[str] = field(default_factory=_new_log)
+    # answer_json_log joined with newlines, kept up to date on every append
+    # so the raw views never have to re-join the whole history.
+    raw_stream: str = ""
+    answer_structured_log: Deque[Dict[str, Any]] = field(default_factory=_new_log)
+    # Incremented whenever answer_structured_log changes, so the Logs tab can
+    # skip re-sending a log it already shows.
+    log_version: int = 0
+
+    def append_raw_output(self, raw_output: str) -> None:
+        """
+        Record a raw model output in answer_json_log and extend the
+        joined raw stream in step.
+        """
+        if len(self.answer_json_log) == self.answer_json_log.maxlen:
+            # Evict the oldest entry ourselves so its text and separator
+            # can be dropped from the joined stream.
+            oldest = self.answer_json_log.popleft()
+            self.raw_stream = self.raw_stream[len(oldest) + 1:]
+        # Entries may be empty strings, so the separator follows the log,
+        # not the truthiness of the joined text.
+        if self.answer_json_log:
+            self.raw_stream = self.raw_stream + "\n" + raw_output
+        else:
+            self.raw_stream = raw_output
+        self.answer_json_log.append(raw_output)
+
+
+# Worker processes shared by all sessions for PDF extraction. PDFium is not
+# thread-safe and PyPDF2 is pure Python, so parsing always happens here
+# rather than on the server's threads. The pool is created on first use and
+# replaced if a worker dies; see _run_in_pool.
+_EXECUTOR: ProcessPoolExecutor | None = None
+_EXECUTOR_LOCK = threading.Lock()
+# Forking a multithreaded server is unsafe, so workers are started from a
+# fork server (or spawned where that is unavailable).
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# Documents with fewer pages than this are extracted by a single worker;
+# splitting short PDFs across workers costs more than it saves.
+PARALLEL_PAGE_THRESHOLD = 16
+# Setup events allowed to run at once. Each upload's parse spends most of
+# its time waiting on the pool, so as many uploads as there are workers
+# can be in flight without one user's upload queueing behind another's.
+UPLOAD_CONCURRENCY_LIMIT = os.cpu_count() or 1
+
+# Characters dropped or expanded when cleaning extracted PDF text: soft
+# hyphens carry no content and ligature glyphs hurt keyword matching.
+_TEXT_TRANSLATION = str.maketrans({
+    "\u00ad": None,
+    "\ufb00": "ff",
+    "\ufb01": "fi",
+    "\ufb02": "fl",
+    "\ufb03": "ffi",
+    "\ufb04": "ffl",
+    "\ufb05": "st",
+    "\ufb06": "st",
+})
+_LINE_BREAK_RE = re.compile(r"\r\n?")
+_HORIZONTAL_SPACE_RE = re.compile(r"[^\S\n]+")
+
+# Extracted page texts of recently uploaded PDFs keyed by the SHA-256 of the
+# file bytes, so re-uploading the same document skips parsing entirely.
+PDF_CACHE_SIZE = 16
+_pdf_pages_cache: OrderedDict[str, List[str]] = OrderedDict()
+_pdf_pages_cache_lock = threading.Lock()
+
+# Documents longer than this many characters (roughly 100k tokens) are not
+# sent whole; each question instead gets the RETRIEVAL_TOP_K pages that
+# match it best under BM25.
+MAX_FULL_CONTEXT_CHARS = 400_000
+RETRIEVAL_TOP_K = 8
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _json_loads(text: str) -> Any:
+    """
+    Parse JSON text with orjson if installed, else the standard library.
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
 
-# Global state for the application. In a multi‑user environment you'd
-# scope these to individual sessions.
-pdf_text_content: str = ""
-api_key: str = ""
-gemini_call: Callable[[str], str] | None = None
-conversation_logs: List[str] = []
-answer_json_log: List[str] = []
-answer_structured_log: List[Dict[str, Any]] = []
+def _json_dumps(obj: Any) -> str:
+    """
+    Serialise ``obj`` to a JSON string, keeping non-ASCII characters
+    as-is. Uses orjson if installed, else the standard library.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _decode_answer(pattern: re.Pattern[str], model_output: str) -> str | None:
+    """
+    Return the ``answer`` string matched by ``pattern`` in the model's
+    JSON output, or None if it is absent or cannot be decoded.
+    """
+    match = pattern.search(model_output)
+    if match is None:
+        return None
+    try:
+        return json.loads(f'"{match.group(1)}"')
+    except ValueError:
+        # While streaming, the chunk boundary may split an escape sequence.
+        return None
+
+
+def _partial_answer_reader() -> Callable[[str], str | None]:
+    """
+    Return a function that takes the model output received so far and
+    returns the (possibly incomplete) ``answer`` string, or None if it has
+    not started yet.
 
+    The reader remembers where the answer starts and how much of it has
+    been decoded, so each call only decodes text that arrived since the
+    previous one and stops once the closing quote has been seen.
+    """
+    start: int | None = None
+    decoded_to = 0
+    answer = ""
+    closed = False
+
+    def read(model_output: str) -> str | None:
+        nonlocal start, decoded_to, answer, closed
+        if start is None:
+            match = ANSWER_START_RE.search(model_output)
+            if match is None:
+                return None
+            start = decoded_to = match.end()
+        if closed or decoded_to == len(model_output):
+            return answer
+        body = STRING_BODY_RE.match(model_output, decoded_to)
+        try:
+            text = json.loads(f'"{body.group()}"')
+        except ValueError:
+            return answer
+        # The body stops early at the closing quote or at an escape that
+        # hasn't fully arrived yet.
+        closed = model_output.startswith('"', body.end())
+        if not closed and text and "\ud800" <= text[-1] <= "\udbff":
+            # Hold back a high surrogate until its pair arrives.
+            return answer
+        answer += text
+        decoded_to = body.end()
+        return answer
+
+    return read
+
+
+def _extract_answer(model_output: str) -> str | None:
+    """
+    Return the complete ``answer`` string from the model's JSON output
+    without parsing the rest of the document, or None if it is missing
+    or not a string.
+    """
+    return _decode_answer(ANSWER_RE, model_output)
 
-def parse_pdf(file_obj) -> str:
+
+def _file_path(file_obj) -> str | None:
+    """
+    Return the filesystem path behind an uploaded file, which Gradio
+    passes either as a path or as a tempfile wrapper.
     """
-    Extract text from a PDF using PyPDF2.
+    if isinstance(file_obj, (str, Path)):
+        return str(file_obj)
+    return getattr(file_obj, "name", None)
 
-    If PyPDF2 is not installed or an error occurs, a descriptive
-    message is returned instead.
+
+def _clean_text(text: str) -> str:
+    """
+    Normalise text extracted from a PDF: drop soft hyphens, expand
+    ligatures, convert CRLF line breaks and collapse runs of other
+    whitespace to a single space.
+    """
+    text = _LINE_BREAK_RE.sub("\n", text.translate(_TEXT_TRANSLATION))
+    return _HORIZONTAL_SPACE_RE.sub(" ", text)
+
+
+_T = TypeVar("_T")
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    Return the shared extraction pool, creating it on first use.
+    """
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_MP_CONTEXT)
+        return _EXECUTOR
+
+
+def _replace_executor(broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+    """
+    Replace the shared pool if it is still ``broken``, and return the
+    current pool. Several threads may notice the same breakage, so only
+    the first one swaps in a new pool.
+    """
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            _EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_MP_CONTEXT)
+        return _EXECUTOR
+
+
+def _run_in_pool(work: Callable[[ProcessPoolExecutor], _T]) -> _T:
+    """
+    Run ``work`` against the shared extraction pool. If a worker died
+    (a PDFium crash or an OOM kill leaves the whole pool unusable), the
+    pool is rebuilt and ``work`` retried once.
+    """
+    executor = _get_executor()
+    try:
+        return work(executor)
+    except BrokenProcessPool:
+        logger.warning("PDF extraction pool broke; restarting it and retrying once.")
+        return work(_replace_executor(executor))
+
+
+def _page_texts(pdf, start: int, stop: int) -> List[str]:
+    """
+    Return the text of pages ``start`` to ``stop`` (exclusive) of an open
+    pypdfium2 document.
+    """
+    texts = []
+    for index in range(start, stop):
+        page = pdf[index]
+        textpage = page.get_textpage()
+        texts.append(textpage.get_text_range())
+        textpage.close()
+        page.close()
+    return texts
+
+
+def _extract_short_pdf(pdf_path: str) -> Tuple[int, List[str] | None]:
+    """
+    Return the page count of a PDF and, if it has fewer than
+    PARALLEL_PAGE_THRESHOLD pages, the text of every page (otherwise
+    None). Runs inside a worker process, so a short document costs one
+    round trip to the pool and is opened only once.
+    """
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        page_count = len(pdf)
+        if page_count < PARALLEL_PAGE_THRESHOLD:
+            return page_count, _page_texts(pdf, 0, page_count)
+        return page_count, None
+    finally:
+        pdf.close()
+
+
+def _extract_page_range(pdf_path: str, start: int, stop: int) -> List[str]:
+    """
+    Extract the text of pages ``start`` to ``stop`` (exclusive) with
+    pypdfium2. Runs inside worker processes, so the document is opened
+    afresh here rather than shared with the caller.
+    """
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return _page_texts(pdf, start, stop)
+    finally:
+        pdf.close()
+
+
+def _parse_pdf_pdfium(pdf_path: str) -> List[str]:
+    """
+    Extract the text of each page of a PDF using pypdfium2, spreading
+    page ranges over a process pool for larger documents.
+    """
+    page_count, texts = _run_in_pool(lambda pool: pool.submit(_extract_short_pdf, pdf_path).result())
+    if texts is not None:
+        return texts
+    workers = min(os.cpu_count() or 1, page_count)
+    step = -(-page_count // workers)
+    starts = range(0, page_count, step)
+    stops = [min(start + step, page_count) for start in starts]
+    chunks = _run_in_pool(lambda pool: list(pool.map(_extract_page_range, repeat(pdf_path), starts, stops)))
+    return [text for chunk in chunks for text in chunk]
+
+
+def _parse_pdf_pypdf2(stream) -> List[str]:
+    """
+    Extract the text of each page of a PDF stream using PyPDF2.
     """
-    if file_obj is None:
-        return ""
-    if PdfReader is None:
-        return (
-            "PyPDF2 is not installed. Please install it via pip to enable "
-            "PDF parsing."
+    reader = PdfReader(stream)
+    return [page.extract_text() or "" for page in reader.pages]
+
+
+def _parse_pdf_pypdf2_file(pdf_path: str) -> List[str]:
+    """
+    Extract the text of each page of the PDF at ``pdf_path`` using PyPDF2.
+    """
+    # Map the file rather than reading it into memory; PyPDF2 only needs a
+    # seekable stream and the kernel pages data in on demand.
+    with open(pdf_path, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return _parse_pdf_pypdf2(mapped)
+
+
+def _extract_pages(file_obj) -> List[str]:
+    """
+    Extract the text of each page of a PDF using pypdfium2, or PyPDF2 if
+    pypdfium2 is not installed, normalised with ``_clean_text``.
+
+    Raises ImportError if neither library is installed, and propagates
+    any error from the extraction itself.
+    """
+    pdf_path = _file_path(file_obj)
+    if pdfium is not None and pdf_path is not None:
+        pages = _parse_pdf_pdfium(pdf_path)
+    elif PdfReader is None:
+        raise ImportError(
+            "Neither pypdfium2 nor PyPDF2 is installed. Please install one "
+            "of them via pip to enable PDF parsing."
+        )
+    elif pdf_path is None:
+        pages = _parse_pdf_pypdf2(file_obj)
+    else:
+        pages = _run_in_pool(lambda pool: pool.submit(_parse_pdf_pypdf2_file, pdf_path).result())
+    return [_clean_text(page) for page in pages]
+
+
+def _extraction_error_message(exc: Exception) -> str:
+    """
+    Return the descriptive message reported when extraction fails with
+    ``exc``.
+    """
+    if isinstance(exc, ImportError):
+        return str(exc)
+    logger.exception("Error parsing PDF", exc_info=exc)
+    return f"Error parsing PDF: {exc}"
+
+
+def _hash_file(path: str) -> str:
+    """
+    Return the hex SHA-256 digest of the file at ``path``.
+    """
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        # Hash the mapped pages directly instead of copying the file into
+        # intermediate bytes objects.
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+
+
+def load_pdf_pages(pdf_file) -> List[str]:
+    """
+    Return the page texts of an uploaded PDF, reusing the result of an
+    earlier successful extraction of identical bytes when one is cached.
+
+    Errors from hashing or extracting the file are raised rather than
+    cached, so a transient error (or a library installed later) doesn't
+    stick to the document.
+    """
+    pdf_path = _file_path(pdf_file)
+    if pdf_path is None:
+        return _extract_pages(pdf_file)
+    key = _hash_file(pdf_path)
+    with _pdf_pages_cache_lock:
+        if key in _pdf_pages_cache:
+            _pdf_pages_cache.move_to_end(key)
+            return _pdf_pages_cache[key]
+    pages = _extract_pages(pdf_file)
+    if pages:
+        with _pdf_pages_cache_lock:
+            _pdf_pages_cache[key] = pages
+            if len(_pdf_pages_cache) > PDF_CACHE_SIZE:
+                _pdf_pages_cache.popitem(last=False)
+    return pages
+
+
+def _tokenize(text: str) -> List[str]:
+    """
+    Split text into lower-cased word tokens for BM25 scoring.
+    """
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _build_page_index(pages: List[str]):
+    """
+    Build a BM25 index over the pages of a document.
+    """
+    return BM25Okapi([_tokenize(page) for page in pages])
+
+
+def _retrieve_context(session: Session, question: str) -> str:
+    """
+    Return the document context for ``question``: the RETRIEVAL_TOP_K
+    pages that score highest against it under BM25, in document order
+    and labelled with their page numbers.
+    """
+    pages = session.pdf_pages
+    indices = session.page_index.get_top_n(_tokenize(question), range(len(pages)), n=RETRIEVAL_TOP_K)
+    selected = "\n".join(f"[Page {i + 1}]\n{pages[i]}" for i in sorted(indices))
+    return f"Document contents (most relevant pages):\n{selected}\n\n"
+
+
+def _create_context_cache(client, context: str) -> str | None:
+    """
+    Upload ``context`` to Gemini's context cache with a google-genai
+    ``client`` and return the cache name, or None if caching is
+    unavailable (for example when the context is below the model's
+    minimum cacheable size).
+    """
+    try:
+        cache = client.caches.create(
+            model=GEMINI_MODEL,
+            config={"contents": [context], "ttl": CONTEXT_CACHE_TTL},
         )
+        return cache.name
+    except Exception as exc:
+        logger.warning("Gemini context caching unavailable, sending full prompts: %s", exc)
+        return None
+
+
+def _delete_context_cache(client, cache_name: str) -> None:
+    """
+    Delete a Gemini context cache, logging rather than raising on
+    failure (it expires on its own after CONTEXT_CACHE_TTL anyway).
+    """
+    try:
+        client.caches.delete(name=cache_name)
+    except Exception as exc:
+        logger.warning("Could not delete Gemini context cache %s: %s", cache_name, exc)
+
+
+def _close_client(client) -> None:
+    """
+    Close a google-genai client's sync and async transports. Must be
+    called from a thread without a running event loop: the async client
+    only schedules its own cleanup when one is running.
+    """
     try:
-        reader = PdfReader(file_obj)
-        text = ""
-        for page in reader.pages:
-            page_text = page.extract_text() or ""
-            text += page_text + "\n"
-        return text
+        client.close()
+        asyncio.run(client.aio.aclose())
     except Exception as exc:
-        logger.exception("Error parsing PDF", exc_info=exc)
-        return f"Error parsing PDF: {exc}"
+        logger.warning("Could not close Gemini client: %s", exc)
 
 
-def init_gemini_client(provided_key: str) -> Callable[[str], str]:
+def _is_cache_miss(exc: Exception) -> bool:
     """
-    Initialise and return a function that calls the Gemini API using
-    the provided API key. Attempts to use google-genai first, then
-    google-generativeai, falling back to a stub if both are unavailable.
+    Return True if a google-genai error means the referenced context
+    cache no longer exists, typically because its TTL ran out.
+    """
+    return (
+        isinstance(exc, genai_errors.ClientError)
+        and exc.code in (400, 403, 404)
+        and "cache" in str(exc).lower()
+    )
+
+
+def _release_noop() -> None:
+    """
+    Release function for backends that hold no server-side resources.
+    """
+
+
+def init_gemini_client(
+    provided_key: str, context: str = ""
+) -> Tuple[Callable[[str], AsyncIterator[str]], Callable[[], None]]:
+    """
+    Initialise a Gemini client for the provided API key and return two
+    functions: an async generator function that sends a question and
+    yields the response text as it streams in, and a release function
+    that deletes its context cache and closes its connections.
+
+    ``context`` (the contract and document text) is prepended to every
+    question; with google-genai it is stored in Gemini's context cache
+    once so only the question is sent per call. If the cache has expired
+    it is recreated, or the full context is sent if that fails. Attempts
+    to use google-genai first, then google-generativeai, falling back to
+    a stub if both are unavailable.
     """
-    global api_key
-    api_key = provided_key
     if not provided_key:
         raise ValueError("API key is required to initialise the Gemini client.")
 
+    # Everything the returned callables need is resolved here and captured
+    # in their closures, so a call makes no global or repeated attribute
+    # lookups to reach the backend.
+    model_name = GEMINI_MODEL
+
     if genai is not None:
-        def call_with_genai(messages: str) -> str:
-            client = genai.Client(api_key=api_key)
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=messages,
-            )
-            return response.text
-        return call_with_genai
+        # One client per setup, so every question reuses its connection pool.
+        client = genai.Client(api_key=provided_key)
+        generate_stream = client.aio.models.generate_content_stream
+        cache_name = _create_context_cache(client, context) if context else None
+
+        async def stream_text(contents: str, config: Dict[str, Any] | None = None) -> AsyncIterator[str]:
+            stream = await generate_stream(model=model_name, contents=contents, config=config)
+            async for chunk in stream:
+                text = chunk.text
+                if text:
+                    yield text
+
+        async def call_with_genai(question: str) -> AsyncIterator[str]:
+            nonlocal cache_name
+            if cache_name is not None:
+                yielded = False
+                try:
+                    async for text in stream_text(question, {"cached_content": cache_name}):
+                        yielded = True
+                        yield text
+                    return
+                except Exception as exc:
+                    if yielded or not _is_cache_miss(exc):
+                        raise
+                    logger.info("Gemini context cache %s expired; recreating it.", cache_name)
+                    cache_name = await asyncio.to_thread(_create_context_cache, client, context)
+                if cache_name is not None:
+                    async for text in stream_text(question, {"cached_content": cache_name}):
+                        yield text
+                    return
+            # No cache (too small, unsupported or not recreatable): send the
+            # whole context with the question.
+            async for text in stream_text(context + question):
+                yield text
+
+        def release_genai() -> None:
+            nonlocal cache_name
+            name, cache_name = cache_name, None
+            if name is not None:
+                _delete_context_cache(client, name)
+            _close_client(client)
+
+        return call_with_genai, release_genai
 
     if generativeai is not None:
-        generativeai.configure(api_key=api_key)
-        model = generativeai.GenerativeModel("gemini-2.5-flash")
-        def call_with_generativeai(messages: str) -> str:
-            response = model.generate_content(messages)
-            return response.text
-        return call_with_generativeai
-
-    def call_stub(_messages: str) -> str:
-        return (
+        generativeai.configure(api_key=provided_key)
+        generate_async = generativeai.GenerativeModel(model_name).generate_content_async
+        async def call_with_generativeai(question: str) -> AsyncIterator[str]:
+            stream = await generate_async(context + question, stream=True)
+            async for chunk in stream:
+                if chunk.parts:
+                    yield chunk.text
+        return call_with_generativeai, _release_noop
+
+    async def call_stub(_question: str) -> AsyncIterator[str]:
+        yield (
             "Neither google‑genai nor google‑generativeai is installed. "
             "Please install one of these packages to enable Gemini API calls."
         )
-    return call_stub
+    return call_stub, _release_noop
 
 
-def upload_and_prepare(pdf_file, user_api_key: str) -> str:
+def release_session(session: Session) -> None:
+    """
+    Free the context cache and connections held by a session's Gemini
+    client. Used as the session state's delete callback; the network
+    calls are handed to a daemon thread so Gradio's cleanup doesn't wait
+    on them.
+    """
+    release, session.release = session.release, None
+    if release is not None:
+        threading.Thread(target=release, daemon=True).start()
+
+
+async def upload_and_prepare(pdf_file, user_api_key: str, session: Session) -> Tuple[str, Session]:
     """
     Handle PDF upload and API key input. Extracts text from the PDF and
-    initialises the Gemini API client.
+    initialises the Gemini API client, storing both on ``session``.
+    Returns a status message and the updated session.
+
+    Hashing, parsing and context-cache creation are blocking, so they run
+    off the event loop; the parse itself is done by the shared pool of
+    worker processes (see ``_run_in_pool``).
     """
-    global pdf_text_content, gemini_call
     if pdf_file is None:
-        return "Please upload a PDF file."
+        return "Please upload a PDF file.", session
     if not user_api_key:
-        return "Please provide your Gemini API key."
-    pdf_text_content = parse_pdf(pdf_file)
-    if not pdf_text_content:
-        return "Failed to parse PDF or PDF contained no extractable text."
-    gemini_call = init_gemini_client(user_api_key)
-    conversation_logs.append(
-        json.dumps({"event": "initialised", "message": "Loaded PDF and API key"}, ensure_ascii=False)
+        return "Please provide your Gemini API key.", session
+    try:
+        pdf_pages = await asyncio.to_thread(load_pdf_pages, pdf_file)
+    except Exception as exc:
+        # Report the failure instead of setting up a client (and a billed
+        # context cache) around the error text.
+        return _extraction_error_message(exc), session
+    pdf_text = "\n".join(pdf_pages)
+    if not pdf_text.strip():
+        return "Failed to parse PDF or PDF contained no extractable text.", session
+    if len(pdf_text) > MAX_FULL_CONTEXT_CHARS and BM25Okapi is not None:
+        # Too long to send whole: cache only the contract and retrieve the
+        # relevant pages per question.
+        page_index = await asyncio.to_thread(_build_page_index, pdf_pages)
+        prompt_prefix = PROMPT_CONTRACT + "\n"
+    else:
+        if len(pdf_text) > MAX_FULL_CONTEXT_CHARS:
+            logger.warning("rank_bm25 is not installed; sending the whole document with every question.")
+        page_index = None
+        prompt_prefix = CONTEXT_HEADER + pdf_text + "\n\n"
+    call, release = await asyncio.to_thread(init_gemini_client, user_api_key, prompt_prefix)
+    if session.release is not None:
+        # Drop the previous document's context cache rather than leaving
+        # it billed until its TTL runs out, and close the old client.
+        await asyncio.to_thread(session.release)
+    session.call, session.release = call, release
+    session.api_key = user_api_key
+    session.pdf_text = pdf_text
+    session.pdf_pages = pdf_pages
+    session.page_index = page_index
+    session.conversation_logs.append(
+        _json_dumps({"event": "initialised", "message": "Loaded PDF and API key"})
     )
-    return "PDF loaded and API key set. You can now ask questions about the document."
+    return "PDF loaded and API key set. You can now ask questions about the document.", session
 
 
-def chat(user_message: str, history: List[Tuple[str, str]]):
+async def chat(user_message: str, history: List[Tuple[str, str]], session: Session):
     """
-    Process a user question: send the prompt to Gemini and update
-    history with only the final answer. Store the full JSON and
-    structured logs for developer inspection.
-
-    Returns three values: the updated chat history, an empty string to
-    clear the input box, and a newline‑separated string of all raw JSON
-    outputs. The third return value enables live streaming of the raw
-    model output in the "Raw View" tab.
+    Process a user question: stream the prompt's response from Gemini
+    and update history with only the final answer. Store the full JSON
+    and structured logs for developer inspection.
+
+    This is an async generator so Gradio can render the response while
+    it is generated: the chat shows the ``answer`` field as soon as it
+    starts arriving, and the raw output grows in the "Raw View" tab.
+
+    Each yield produces five values: the updated chat history, an empty
+    string to clear the input box, the newline‑separated string of all
+    raw JSON outputs, the raw response in progress, and the session.
+    The full log only changes once a response completes, so while
+    streaming it is left as is (``gr.update()``) and only the current
+    response is re-sent with each chunk.
     """
-    global gemini_call
-    if not pdf_text_content:
+    if not session.pdf_text:
         history.append((user_message, "Please upload a PDF and set your API key before asking questions."))
-        return history, ""
-    if not api_key:
+        yield history, "", session.raw_stream, gr.update(), session
+        return
+    if not session.api_key:
         history.append((user_message, "API key is missing. Please upload a PDF and provide your key first."))
-        return history, ""
-    # Compose the prompt: contract + document context + user question
-    system_prompt = PROMPT_CONTRACT
-    document_context = f"Document contents:\n{pdf_text_content}\n"
-    messages_for_api = "\n".join([
-        system_prompt,
-        document_context,
-        user_message,
-    ])
+        yield history, "", session.raw_stream, gr.update(), session
+        return
+    history.append((user_message, ""))
+    # The client already holds the contract and, unless the document is
+    # long enough to need retrieval, its full text (cached on Gemini's side
+    # where possible), so only the question and retrieved pages are sent.
+    if session.page_index is not None:
+        question = _retrieve_context(session, user_message) + user_message
+    else:
+        question = user_message
+    model_output = ""
+    read_answer = _partial_answer_reader()
     try:
-        model_output = gemini_call(messages_for_api) if gemini_call else "Gemini client is not initialised."
+        if session.call is None:
+            model_output = "Gemini client is not initialised."
+        else:
+            async for text in session.call(question):
+                model_output += text
+                partial_answer = read_answer(model_output)
+                if partial_answer is not None:
+                    history[-1] = (user_message, partial_answer)
+                # Re-sending the whole log with every chunk would cost
+                # O(history) per token, so only the response is updated.
+                yield history, "", gr.update(), model_output, session
     except Exception as exc:
         logger.exception("Error calling Gemini API", exc_info=exc)
         model_output = f"Error calling Gemini API: {exc}"
@@ -201,52 +818,63 @@ def chat(user_message: str, history: List[Tuple[str, str]]):
     if isinstance(model_output, str):
         stripped = model_output.strip()
         # Remove fenced code blocks (e.g., ```json ... ```)
-        if stripped.startswith("```"):
-            stripped = stripped.strip("`")
-            if "\n" in stripped:
-                stripped = stripped.split("\n", 1)[1]
+        fence = FENCE_RE.match(stripped)
+        if fence is not None:
+            stripped = fence.group(1)
         try:
-            parsed = json.loads(stripped)
-            final_answer = parsed.get("answer")
-            answer_json_log.append(stripped)
-            answer_structured_log.append(parsed)
+            parsed = _json_loads(stripped)
         except Exception:
-            # If parsing fails, store the raw output and use it as the answer
-            answer_json_log.append(stripped)
-            answer_structured_log.append({"raw": stripped})
+            parsed = None
+        session.append_raw_output(stripped)
+        if isinstance(parsed, dict):
+            # Take the answer from the parse so it always matches the
+            # structured log.
+            final_answer = parsed.get("answer")
+            session.answer_structured_log.append(parsed)
+        else:
+            # If parsing fails, store the raw output and read the answer
+            # straight from the text, falling back to the whole output.
+            final_answer = _extract_answer(stripped)
+            session.answer_structured_log.append({"raw": stripped})
+        session.log_version += 1
     if final_answer is None:
         final_answer = model_output if isinstance(model_output, str) else str(model_output)
-    conversation_logs.append(json.dumps({"user": user_message, "answer": final_answer}, ensure_ascii=False))
-    history.append((user_message, final_answer))
-    # Build the raw stream by concatenating all raw JSON outputs. This will be
-    # displayed in the "Raw View" tab for real‑time monitoring.
-    raw_stream = "\n".join(answer_json_log)
-    return history, "", raw_stream
+    session.conversation_logs.append(_json_dumps({"user": user_message, "answer": final_answer}))
+    history[-1] = (user_message, final_answer)
+    # The raw stream of all JSON outputs is displayed in the "Raw View" tab
+    # for real‑time monitoring.
+    yield history, "", session.raw_stream, model_output, session
 
 
-def view_logs() -> str:
+def view_logs(session: Session) -> str:
     """
     Provide a fallback raw log view if structured logs are unavailable.
     """
-    if answer_json_log:
-        return "\n".join(answer_json_log)
-    if conversation_logs:
-        return "\n".join(conversation_logs)
+    if session.answer_json_log:
+        return session.raw_stream
+    if session.conversation_logs:
+        return "\n".join(session.conversation_logs)
     return "No logs available yet."
 
 
-def get_structured_logs() -> List[Dict[str, Any]]:
+def get_structured_logs(session: Session, sent_version: int) -> Tuple[Any, int]:
     """
-    Return the list of parsed JSON outputs.
+    Return the session's list of parsed JSON outputs and the log version
+    it reflects. ``sent_version`` is the version this client already
+    shows; if nothing has been logged since, a no-op update is returned
+    instead of re-sending the whole list.
     """
-    return answer_structured_log
+    if sent_version == session.log_version:
+        return gr.update(), sent_version
+    return list(session.answer_structured_log), session.log_version
 
 
-def get_raw_logs() -> str:
+def get_raw_logs(session: Session) -> str:
     """
-    Return the raw JSON outputs as a single newline separated string.
+    Return the session's raw JSON outputs as a single newline separated
+    string.
     """
-    return "\n".join(answer_json_log) if answer_json_log else ""
+    return session.raw_stream
 
 
 def build_interface() -> gr.Blocks:
@@ -254,6 +882,7 @@ def build_interface() -> gr.Blocks:
     Build the Gradio interface with a Chat tab and a Logs tab.
     """
     with gr.Blocks(title="Gemini Chat‑to‑PDF App") as demo:
+        session_state = gr.State(Session(), delete_callback=release_session)
         gr.Markdown(
             """
             # Chat to PDF with Gemini 2.5 Flash
@@ -298,6 +927,8 @@ def build_interface() -> gr.Blocks:
                 structured_log_json = gr.JSON(
                     label="Structured Logs", value=[]
                 )
+                # Log version currently displayed by this client.
+                structured_log_version = gr.State(0)
                 raw_log_text = gr.Textbox(
                     label="Raw JSON Logs", value="", lines=10, interactive=False, container=True
                 )
@@ -305,33 +936,42 @@ def build_interface() -> gr.Blocks:
                 gr.Markdown(
                     """## Raw View
 
-                    This tab streams the raw JSON outputs from the model in real
-                    time. Each response is appended to the view automatically
-                    when you send a question in the Chat tab.
+                    This tab streams the raw JSON output from the model in real
+                    time. *Current Response* shows the response to the question
+                    you just sent in the Chat tab as it arrives; once it is
+                    complete it is appended to *Raw JSON Stream* below.
                     """
                 )
+                raw_response_box = gr.Textbox(
+                    label="Current Response", value="", lines=10, interactive=False, container=True
+                )
                 raw_view_box = gr.Textbox(
                     label="Raw JSON Stream", value="", lines=20, interactive=False, container=True
                 )
         # Bind events outside the Tabs context so that all components are defined.
         upload_button.click(
             upload_and_prepare,
-            inputs=[pdf_input, api_key_input],
-            outputs=status_output,
+            inputs=[pdf_input, api_key_input, session_state],
+            outputs=[status_output, session_state],
+            concurrency_limit=UPLOAD_CONCURRENCY_LIMIT,
         )
+        # chat is async and keeps all per-user state in the session, so
+        # users' questions can stream in parallel instead of queueing
+        # behind Gradio's default limit of one run per event.
         user_input.submit(
             chat,
-            inputs=[user_input, chatbot],
-            outputs=[chatbot, user_input, raw_view_box],
+            inputs=[user_input, chatbot, session_state],
+            outputs=[chatbot, user_input, raw_view_box, raw_response_box, session_state],
+            concurrency_limit=None,
         )
         refresh_btn.click(
             get_structured_logs,
-            inputs=None,
-            outputs=structured_log_json,
+            inputs=[session_state, structured_log_version],
+            outputs=[structured_log_json, structured_log_version],
         )
         refresh_btn.click(
             get_raw_logs,
-            inputs=None,
+            inputs=session_state,
             outputs=raw_log_text,
         )
     return demo